@@ -1,25 +1,88 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
 from typing import List, Optional
-from bson import ObjectId
-import json, uuid, os
+import asyncio
+import functools
+import msgspec
+import oss2
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+import uuid, os
+import time
 from aliyunsdkcore.client import AcsClient
 from aliyunsdksts.request.v20150401 import AssumeRoleRequest
 from motor.motor_asyncio import AsyncIOMotorClient
+import uvloop
 
-# Initialize FastAPI (only once)
-app = FastAPI(title="Ultralytics Dataset Importer")
+# Swap the default asyncio loop for uvloop before any loop is created.
+# All endpoints are IO-bound (Motor awaits / Aliyun STS+OSS), where
+# event-loop overhead dominates.
+uvloop.install()
 
-# CORS Configuration
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+
+class PureCORS:
+    """Pure ASGI CORS middleware.
+
+    Starlette's CORSMiddleware goes through BaseHTTPMiddleware, which buffers
+    every response body through a memory channel. Here we just append
+    pre-built header tuples on http.response.start and answer OPTIONS
+    preflights directly, without touching the response body.
+    """
+
+    def __init__(self, app, origins, methods=("*",), headers=("*",), max_age=600):
+        self.app = app
+        # Join allow lists into bytes once at init, not per request
+        self._allow_origin = ", ".join(origins).encode("latin-1")
+        self._simple_headers = [
+            (b"access-control-allow-origin", self._allow_origin),
+            (b"access-control-allow-credentials", b"true"),
+        ]
+        self._preflight_headers = self._simple_headers + [
+            (b"access-control-allow-methods", ", ".join(methods).encode("latin-1")),
+            (b"access-control-allow-headers", ", ".join(headers).encode("latin-1")),
+            (b"access-control-max-age", str(max_age).encode("latin-1")),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # Short-circuit preflight without hitting the downstream app
+        if scope["method"] == "OPTIONS":
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": self._preflight_headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message["headers"]) + self._simple_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+# Initialize FastAPI (only once); orjson serializes the large image/dataset
+# arrays several times faster than stdlib json and emits bytes directly
+app = FastAPI(
+    title="Ultralytics Dataset Importer", default_response_class=ORJSONResponse
 )
 
+# Compress large JSON list responses (dataset/image listings).
+# Added before PureCORS so CORS ends up outermost in the stack.
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+# CORS Configuration
+app.add_middleware(PureCORS, origins=["http://localhost:3000"])
+
 # Configuration
 ALIYUN_ACCESS_KEY_ID = os.getenv("ALIYUN_ACCESS_KEY_ID")
 ALIYUN_ACCESS_KEY_SECRET = os.getenv("ALIYUN_ACCESS_KEY_SECRET")
@@ -33,32 +96,18 @@ mongo_client = AsyncIOMotorClient(MONGO_URI)
 db = mongo_client.yolo_datasets
 
 
-# Pydantic Models (solve ObjectId serialization issue)
-class PyObjectId(ObjectId):
-    @classmethod
-    def __get_validators__(cls):
-        yield cls.validate
-
-    @classmethod
-    def validate(cls, v):
-        if not ObjectId.is_valid(v):
-            return v
-        return ObjectId(v)
-
-
-class DatasetModel(BaseModel):
-    id: str = Field(alias="_id")
+# Response Models (msgspec Structs: validate + encode the big list
+# responses far faster than Pydantic v1 per-document validation)
+class DatasetModel(msgspec.Struct, rename={"id": "_id"}):
+    id: str
     name: str
     status: str
     nc: Optional[int] = None
     names: Optional[List[str]] = None
     splits: Optional[List[str]] = None
 
-    class Config:
-        allow_population_by_field_name = True
 
-
-class ImageModel(BaseModel):
+class ImageModel(msgspec.Struct):
     dataset_id: str
     filename: str
     split: str
@@ -78,19 +127,87 @@ class CompleteRequest(BaseModel):
     filename: str
 
 
+# OSS signing
+SIGN_URL_EXPIRES = 3600  # seconds
+
+# (dataset_id, filename) -> (valid_until, url); entries are reused for half
+# their signing window so clients always get at least 30 min of validity.
+_signed_url_cache = {}
+
+# Small pool for sign_url's HMAC work, shared across requests
+_sign_executor = ThreadPoolExecutor(max_workers=8)
+
+
+@functools.lru_cache(maxsize=1)
+def get_oss_bucket():
+    """Shared OSS Bucket client (built once, reused across requests)"""
+    auth = oss2.Auth(
+        access_key_id=ALIYUN_ACCESS_KEY_ID,
+        access_key_secret=ALIYUN_ACCESS_KEY_SECRET,
+    )
+    return oss2.Bucket(
+        auth,
+        endpoint=f"https://oss-{OSS_REGION}.aliyuncs.com",
+        bucket_name=os.getenv("OSS_BUCKET"),
+    )
+
+
+def sign_image_url(dataset_id: str, filename: str) -> str:
+    """Sign a GET URL for an image, with a half-expiry TTL cache"""
+    key = (dataset_id, filename)
+    now = time.monotonic()
+    cached = _signed_url_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    if len(_signed_url_cache) > 50000:
+        _signed_url_cache.clear()
+    oss_key = f"datasets/{dataset_id}/images/{filename}"
+    url = get_oss_bucket().sign_url("GET", oss_key, SIGN_URL_EXPIRES)
+    _signed_url_cache[key] = (now + SIGN_URL_EXPIRES / 2, url)
+    return url
+
+
+@app.on_event("startup")
+async def create_indexes():
+    """Ensure the indexes the list endpoints rely on exist (idempotent)"""
+    await db.images.create_index([("dataset_id", 1), ("split", 1)])
+    await db.datasets.create_index("status")
+
+
+# STS credentials
+STS_DURATION = 3600  # seconds
+
+# role_arn -> (valid_until, credentials); refreshed 10 min before expiry so
+# clients never receive credentials about to lapse mid-upload.
+_sts_cache = {}
+
+
+def get_sts_credentials():
+    """AssumeRole credentials, cached within their validity window"""
+    now = time.monotonic()
+    cached = _sts_cache.get(ALIYUN_ROLE_ARN)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    request = AssumeRoleRequest.AssumeRoleRequest()
+    request.set_RoleArn(ALIYUN_ROLE_ARN)
+    request.set_RoleSessionName(f"upload-{uuid.uuid4().hex[:8]}")
+    request.set_DurationSeconds(STS_DURATION)
+    response = acs_client.do_action_with_exception(request)
+    creds = orjson.loads(response)["Credentials"]
+    _sts_cache[ALIYUN_ROLE_ARN] = (now + STS_DURATION - 600, creds)
+    return creds
+
+
 # === API Endpoints ===
 
 
 @app.post("/api/oss/auth")
-def get_oss_sts_token(req: AuthRequest):
+async def get_oss_sts_token(req: AuthRequest):
     """Get OSS temporary upload credentials (Aliyun STS)"""
     try:
-        request = AssumeRoleRequest.AssumeRoleRequest()
-        request.set_RoleArn(ALIYUN_ROLE_ARN)
-        request.set_RoleSessionName(f"upload-{uuid.uuid4().hex[:8]}")
-        request.set_DurationSeconds(3600)
-        response = acs_client.do_action_with_exception(request)
-        creds = json.loads(response)["Credentials"]
+        # The Aliyun SDK call is blocking; run it in a thread so a slow
+        # STS round trip can't starve the event loop or the threadpool
+        creds = await asyncio.to_thread(get_sts_credentials)
         object_key = f"uploads/{uuid.uuid4()}/{req.filename}"
         return {"credentials": creds, "objectKey": object_key}
     except Exception as e:
@@ -114,47 +231,61 @@ async def upload_complete(req: CompleteRequest):
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
 
-@app.get("/api/datasets", response_model=List[DatasetModel])
+@app.get("/api/datasets")
 async def list_datasets():
     """Return list of all datasets (for frontend display)"""
-    datasets = await db.datasets.find().to_list(None)
-    return datasets
+    # Project to the response-model fields and bound the batch so a huge
+    # collection (or fat error traces on failed docs) can't blow up memory
+    datasets = await db.datasets.find(
+        {},
+        projection={"_id": 1, "name": 1, "status": 1, "nc": 1, "names": 1, "splits": 1},
+    ).to_list(length=1000)
+    return Response(
+        msgspec.json.encode(msgspec.convert(datasets, List[DatasetModel])),
+        media_type="application/json",
+    )
 
 
-@app.get("/api/datasets/{dataset_id}/images", response_model=List[ImageModel])
+@app.get("/api/datasets/{dataset_id}/images")
 async def list_images(dataset_id: str):
     """Return all images and annotations for the specified dataset"""
     images = await db.images.find({"dataset_id": dataset_id}).to_list(None)
-    return images
+    return Response(
+        msgspec.json.encode(msgspec.convert(images, List[ImageModel])),
+        media_type="application/json",
+    )
 
 
 @app.get("/api/datasets/{dataset_id}/images-signed")
 async def get_signed_image_urls(dataset_id: str):
     """Return list of signed image URLs (valid for 1 hour)"""
-    import oss2
-
-    auth = oss2.Auth(
-        access_key_id=os.getenv("ALIYUN_ACCESS_KEY_ID"),
-        access_key_secret=os.getenv("ALIYUN_ACCESS_KEY_SECRET"),
-    )
-    bucket = oss2.Bucket(
-        auth,
-        endpoint=f"https://oss-{os.getenv('OSS_REGION')}.aliyuncs.com",
-        bucket_name=os.getenv("OSS_BUCKET"),
+    # Server-side projection via aggregation; signing is pushed to a small
+    # thread pool as docs arrive, so HMAC CPU overlaps the next batch fetch
+    cursor = db.images.aggregate(
+        [
+            {"$match": {"dataset_id": dataset_id}},
+            {"$limit": 10},
+            {"$project": {"filename": 1, "split": 1, "annotations": 1, "_id": 0}},
+        ],
+        hint="dataset_id_1_split_1",
+        batchSize=100,
     )
+    loop = asyncio.get_running_loop()
+    pending = []
+    async for img in cursor:
+        future = loop.run_in_executor(
+            _sign_executor, sign_image_url, dataset_id, img["filename"]
+        )
+        pending.append((img, future))
 
-    # Get image list
-    images = await db.images.find({"dataset_id": dataset_id}).to_list(10)
     signed_urls = []
-    for img in images:
-        oss_key = f"datasets/{dataset_id}/images/{img['filename']}"
-        url = bucket.sign_url("GET", oss_key, 3600)  # Valid for 1 hour
+    for img, future in pending:
         signed_urls.append(
             {
                 "filename": img["filename"],
                 "split": img["split"],
                 "annotations": img["annotations"],
-                "signed_url": url,
+                "signed_url": await future,
             }
         )
     return signed_urls
